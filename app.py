@@ -1,30 +1,56 @@
-from flask import Flask, request, jsonify, render_template, send_file
+from flask import Flask, request, jsonify, render_template, send_file, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
+from flask_caching import Cache
+from flask_compress import Compress
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
 from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
 import os, io
+import orjson
 import pandas as pd
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
-from reportlab.platypus import Image
-from reportlab.lib.utils import ImageReader
 
-from datetime import datetime
-import pytz
+# CREATE FLASK APP
+app = Flask(__name__)
 
-IST = pytz.timezone("Asia/Kolkata")
+# POS request bodies are a few small JSON fields; reject anything bigger
+app.config["MAX_CONTENT_LENGTH"] = 4 * 1024
 
-def now_ist():
-    return datetime.now(IST)
+# Off by default: without a proxy in front, clients could forge
+# X-Forwarded-For. Behind one (Render: one hop) set PROXY_FIX_X_FOR=1 so
+# request.remote_addr is the client.
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ.get("PROXY_FIX_X_FOR", 0)))
 
-# CREATE FLASK APP
-app = Flask(__name__)
+# ==================================================
+# JSON PROVIDER (ORJSON)
+# ==================================================
+class ORJSONProvider(DefaultJSONProvider):
+    # Same fallbacks as Flask (Decimal, dataclasses...) for types orjson lacks
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app.json = ORJSONProvider(app)
 
 # ==================================================
 # IST CONVERSION HELPER
 # ==================================================
 IST = timezone(timedelta(hours=5, minutes=30))
 
+def now_ist():
+    return datetime.now(IST)
+
 def to_ist(dt):
     if not dt:
         return None
@@ -48,15 +74,27 @@ if DATABASE_URL:
     if DATABASE_URL.startswith("postgres://"):
         DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
 
+    # Name the driver: SQLAlchemy 2.1 maps bare postgresql:// to psycopg 3,
+    # but requirements.txt ships psycopg2
+    if DATABASE_URL.startswith("postgresql://"):
+        DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+psycopg2://", 1)
+
     app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL
 
+    # One pool per gunicorn worker: size it to the worker's thread count.
+    # DATABASE_URL may point at PgBouncer (transaction pooling): psycopg2
+    # never uses server-side prepared statements, so no connect_args are
+    # needed; keep the pool small and pre_ping on.
     app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_pre_ping": True,
-    "pool_recycle": 180,
-    "pool_size": 3,
-    "max_overflow": 2,
-    "pool_timeout": 30
-}
+        "pool_pre_ping": True,
+        "pool_recycle": 180,
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 3)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 2)),
+        "pool_timeout": 30,
+        "pool_use_lifo": True,
+        # Compiled-SQL cache per engine; room for every statement in the app
+        "query_cache_size": 1200
+    }
 
 else:
     app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///thirupugazh_pos.db"
@@ -64,6 +102,54 @@ else:
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db = SQLAlchemy(app)
 
+# ==================================================
+# SQL QUERY COUNTER (dev: SQL_QUERY_WARN=<max queries per request>)
+# ==================================================
+# Logs requests that run more statements than expected, e.g. an N+1
+# creeping back into view_cart / checkout. Off (no listener) when unset.
+SQL_QUERY_WARN = int(os.environ.get("SQL_QUERY_WARN", 0))
+
+if SQL_QUERY_WARN:
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def count_sql(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context():
+            g.sql_count = g.get("sql_count", 0) + 1
+
+    @app.after_request
+    def warn_sql_count(response):
+        count = g.get("sql_count", 0)
+        if count > SQL_QUERY_WARN:
+            print(f"SQL QUERY WARNING → {request.method} {request.path}: {count} queries")
+        return response
+
+# ==================================================
+# CACHE (REDIS WHEN AVAILABLE, ELSE IN-PROCESS)
+# ==================================================
+REDIS_URL = os.environ.get("REDIS_URL")
+
+if REDIS_URL:
+    app.config["CACHE_TYPE"] = "RedisCache"
+    app.config["CACHE_REDIS_URL"] = REDIS_URL
+else:
+    app.config["CACHE_TYPE"] = "SimpleCache"
+
+app.config["CACHE_DEFAULT_TIMEOUT"] = 300
+cache = Cache(app)
+
+# ==================================================
+# COMPRESSION (JSON + HTML)
+# ==================================================
+# Brotli/gzip for JSON and pages over 500 bytes; Excel/PDF downloads are
+# already compressed and pass through untouched. ETags are re-checked
+# after compression, so /menu and /ui revalidation still returns 304.
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 500
+Compress(app)
+
+MENU_CACHE_KEY = "menu:list"
+MENU_MAX_AGE = 300
+
 # ==================================================
 # MODELS
 # ==================================================
@@ -89,6 +175,17 @@ class Cart(db.Model):
     discount = db.Column(db.Integer, default=0)
     created_at = db.Column(db.DateTime, default=now_ist)
 
+    # Only HOLD carts are ever listed/counted: small partial index that
+    # also returns them in created_at order
+    __table_args__ = (
+        db.Index(
+            "ix_cart_hold_created_at",
+            "created_at",
+            postgresql_where=db.text("status = 'HOLD'"),
+            sqlite_where=db.text("status = 'HOLD'")
+        ),
+    )
+
 class CartItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     cart_id = db.Column(db.Integer, db.ForeignKey("cart.id"))
@@ -98,7 +195,13 @@ class CartItem(db.Model):
     custom_price = db.Column(db.Integer)  # NEW
     custom_name = db.Column(db.String(100))   # NEW
 
-    menu = db.relationship("Menu")
+    # Eager-load explicitly (selectinload) or join; lazy loads raise
+    menu = db.relationship("Menu", lazy="raise_on_sql")
+
+    # One row per menu item per cart; also serves cart_id-only lookups
+    __table_args__ = (
+        db.Index("uq_cart_item_cart_menu", "cart_id", "menu_id", unique=True),
+    )
 
 class Sale(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -112,10 +215,77 @@ class Sale(db.Model):
     customer_name = db.Column(db.String(100))
     customer_phone = db.Column(db.String(20))
     staff_id = db.Column(db.Integer)
-    business_date = db.Column(db.Date)
+    business_date = db.Column(db.Date, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     status = db.Column(db.String(20), default="COMPLETED")
 
+    # Staff reports filter on staff_id + business_date together
+    __table_args__ = (
+        db.Index("ix_sale_staff_date", "staff_id", "business_date"),
+    )
+
+class DailySales(db.Model):
+    __tablename__ = "daily_sales_summary"
+
+    # Running totals of COMPLETED sales per business date
+    business_date = db.Column(db.Date, primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    discount = db.Column(db.Integer, nullable=False, default=0)
+    bill_count = db.Column(db.Integer, nullable=False, default=0)
+
+# ==================================================
+# UPSERT HELPER (POSTGRES ON RENDER, SQLITE LOCALLY)
+# ==================================================
+def dialect_insert(model):
+    if db.engine.dialect.name == "postgresql":
+        return pg_insert(model)
+    return sqlite_insert(model)
+
+# ==================================================
+# DAILY SALES SUMMARY
+# ==================================================
+def record_daily_sale(business_date, total, discount, bill_count=1):
+    # Pass negative values to take a voided sale back out
+    stmt = dialect_insert(DailySales).values(
+        business_date=business_date,
+        total=total,
+        discount=discount,
+        bill_count=bill_count
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["business_date"],
+        set_={
+            "total": DailySales.total + stmt.excluded.total,
+            "discount": DailySales.discount + stmt.excluded.discount,
+            "bill_count": DailySales.bill_count + stmt.excluded.bill_count
+        }
+    )
+    db.session.execute(stmt)
+
+def completed_sales_totals(*criteria):
+    # (bill_count, total, discount) straight from Sale
+    return db.session.query(
+        db.func.count(Sale.id),
+        db.func.coalesce(db.func.sum(Sale.total), 0),
+        db.func.coalesce(db.func.sum(Sale.discount), 0)
+    ).filter(Sale.status == "COMPLETED", *criteria).one()
+
+def rebuild_daily_sales():
+    db.session.execute(db.delete(DailySales))
+    db.session.execute(
+        db.insert(DailySales).from_select(
+            ["business_date", "total", "discount", "bill_count"],
+            db.select(
+                Sale.business_date,
+                db.func.coalesce(db.func.sum(Sale.total), 0),
+                db.func.coalesce(db.func.sum(Sale.discount), 0),
+                db.func.count(Sale.id)
+            )
+            .where(Sale.status == "COMPLETED", Sale.business_date.isnot(None))
+            .group_by(Sale.business_date)
+        )
+    )
+
 # ==================================================
 # BILL NUMBER GENERATOR
 # ==================================================
@@ -141,33 +311,50 @@ def generate_bill_no():
 # ==================================================
 # UI ROUTES
 # ==================================================
+# The pages take no template variables: render each once per process and
+# let browsers revalidate with the ETag (304, no body) on every load
+_rendered_pages = {}
+
+def render_page(template):
+    body = _rendered_pages.get(template)
+
+    if body is None:
+        body = render_template(template)
+        if not app.debug:
+            _rendered_pages[template] = body
+
+    response = app.make_response(body)
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
+
 @app.route("/")
 def home():
     return "Thirupugazh POS API Running"
 
 @app.route("/ui/login")
 def ui_login():
-    return render_template("login.html")
+    return render_page("login.html")
 
 @app.route("/ui/billing")
 def ui_billing():
-    return render_template("billing.html")
+    return render_page("billing.html")
 
 @app.route("/ui/admin-reports")
 def ui_admin_reports():
-    return render_template("admin_reports.html")
+    return render_page("admin_reports.html")
 
 @app.route("/ui/change-password")
 def ui_change_password():
-    return render_template("change_password.html")
+    return render_page("change_password.html")
 
 @app.route("/ui/admin-staff")
 def ui_admin_staff():
-    return render_template("admin_staff.html")
+    return render_page("admin_staff.html")
 
 @app.route("/ui/admin-breakdown")
 def ui_admin_breakdown():
-    return render_template("admin_breakdown.html")
+    return render_page("admin_breakdown.html")
 
 # ==================================================
 # STAFF CASH CLOSING DATA
@@ -181,16 +368,13 @@ def staff_cash_summary():
 
     business_date = get_business_date()
 
-    sales = Sale.query.filter_by(
-        staff_id=staff_id,
-        business_date=business_date
-    ).all()
-
-    expected_cash = 0
-
-    for s in sales:
-        if s.payment_method == "CASH":
-            expected_cash += s.total
+    expected_cash = db.session.query(
+        db.func.coalesce(db.func.sum(Sale.total), 0)
+    ).filter(
+        Sale.staff_id == staff_id,
+        Sale.business_date == business_date,
+        Sale.payment_method == "CASH"
+    ).scalar()
 
     return jsonify({
         "expected_cash": expected_cash
@@ -201,34 +385,110 @@ def staff_cash_summary():
 # ==================================================
 @app.route("/admin/sale/void", methods=["POST"])
 def admin_void_sale():
-    data = request.json
+    data = request.get_json(silent=True) or {}
     sale_id = data.get("sale_id")
 
-    sale = Sale.query.get(sale_id)
+    sale = db.session.get(Sale, sale_id)
 
     if not sale:
         return jsonify({"status": "not_found"}), 404
 
-    if sale.status == "VOID":
+    staff_id, business_date = sale.staff_id, sale.business_date
+
+    # Conditional UPDATE: of two concurrent voids only one matches a row,
+    # so the sale is taken out of the summary once
+    voided = db.session.execute(
+        db.update(Sale)
+        .where(Sale.id == sale.id, Sale.status == "COMPLETED")
+        .values(status="VOID")
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    if not voided:
+        db.session.rollback()
         return jsonify({"status": "already_void"})
 
-    sale.status = "VOID"
+    if business_date:
+        record_daily_sale(business_date, -sale.total, -(sale.discount or 0), -1)
+
     db.session.commit()
 
+    if staff_id and business_date:
+        cache.delete(staff_report_key(staff_id, business_date))
+
     return jsonify({"status": "ok"})
 
+# ==================================================
+# PASSWORD HASHING
+# ==================================================
+# werkzeug's scrypt default (~95 ms per verify). pbkdf2-sha256 only gets
+# cheaper below OWASP's 600k iterations, so it isn't the default; any
+# werkzeug method string can be set here instead.
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+
+def hash_password(password):
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+def hash_method(password_hash):
+    # "scrypt:32768:8:1$salt$hash" -> "scrypt:32768:8:1"
+    return password_hash.split("$", 1)[0]
+
+def needs_rehash(password_hash):
+    # Anything not made with the current method and cost is moved to it
+    return hash_method(password_hash) != hash_method(dummy_password_hash())
+
+# Checked when the username doesn't exist, so a miss takes as long as a
+# wrong password and response time doesn't reveal valid usernames. Same
+# method as stored hashes (needs_rehash keeps them on it); built on first
+# use so importing app (workers, CLI commands) does no KDF work.
+_dummy_password_hash = None
+
+def dummy_password_hash():
+    global _dummy_password_hash
+    if _dummy_password_hash is None:
+        _dummy_password_hash = hash_password(os.urandom(16).hex())
+    return _dummy_password_hash
+
 # ==================================================
 # AUTH
 # ==================================================
+# Built once at import so every call reuses the cached compiled SQL
+LOGIN_USER_STMT = db.select(User).where(User.username == db.bindparam("username"))
+
+# Failed logins per client IP + username before that pair is locked for
+# LOGIN_LOCKOUT_SECONDS. Needs Redis: SimpleCache counts per worker.
+LOGIN_LOCKOUT_ENABLED = bool(REDIS_URL)
+LOGIN_MAX_FAILURES = int(os.environ.get("LOGIN_MAX_FAILURES", 5))
+LOGIN_LOCKOUT_SECONDS = int(os.environ.get("LOGIN_LOCKOUT_SECONDS", 60))
+
 @app.route("/login", methods=["POST"])
 def login():
-    data = request.json
-    user = User.query.filter_by(username=data.get("username")).first()
+    data = request.get_json(silent=True) or {}
+    fail_key = f"login:fail:{request.remote_addr}:{data.get('username')}"
+    failures = (cache.get(fail_key) or 0) if LOGIN_LOCKOUT_ENABLED else 0
+
+    # Before the DB lookup and password hash, so locked guesses cost nothing
+    if failures >= LOGIN_MAX_FAILURES:
+        return jsonify({"status": "locked"}), 429
+
+    user = db.session.execute(
+        LOGIN_USER_STMT, {"username": data.get("username")}
+    ).scalar_one_or_none()
+
+    password_hash = user.password if user else dummy_password_hash()
 
-    if user and check_password_hash(user.password, data.get("password")):
+    if check_password_hash(password_hash, data.get("password") or "") and user:
         if user.status != "ACTIVE":
             return jsonify({"status": "disabled"}), 403
 
+        # Move hashes from another method / cost to the current one
+        if needs_rehash(user.password):
+            user.password = hash_password(data.get("password"))
+            db.session.commit()
+
+        if failures:
+            cache.delete(fail_key)
+
         return jsonify({
             "status": "ok",
             "user_id": user.id,
@@ -236,19 +496,28 @@ def login():
             "role": user.role
         })
 
+    if LOGIN_LOCKOUT_ENABLED:
+        # SETNX + INCR on the backend (Flask-Caching has no inc): concurrent
+        # failures all count and the TTL is only set once
+        cache.add(fail_key, 0, timeout=LOGIN_LOCKOUT_SECONDS)
+        cache.cache.inc(fail_key)
     return jsonify({"status": "error"}), 401
 # ==================================================
 # CHANGE PASSWORD
 # ==================================================
 @app.route("/change-password", methods=["POST"])
 def change_password():
-    data = request.json
-    user = User.query.get(data.get("user_id"))
+    data = request.get_json(silent=True) or {}
+
+    if not all(data.get(k) for k in ("user_id", "old_password", "new_password")):
+        return jsonify({"status": "error", "message": "Missing fields"}), 400
+
+    user = db.session.get(User, data.get("user_id"))
 
     if not user or not check_password_hash(user.password, data.get("old_password")):
         return jsonify({"status": "error"}), 400
 
-    user.password = generate_password_hash(data.get("new_password"))
+    user.password = hash_password(data.get("new_password"))
     db.session.commit()
     return jsonify({"status": "ok"})
 
@@ -256,31 +525,37 @@ def change_password():
 # DASHBOARD API
 # ==================================================
 @app.route("/admin/dashboard")
+@cache.cached(timeout=15)
 def admin_dashboard():
     today = get_business_date()
 
     # Today's sales
-    today_sales = Sale.query.filter_by(business_date=today).all()
-    today_total = sum(s.total for s in today_sales)
+    today_total, today_bills = db.session.query(
+        db.func.coalesce(db.func.sum(Sale.total), 0),
+        db.func.count(Sale.id)
+    ).filter(Sale.business_date == today).one()
 
     # Hold carts
     hold_count = Cart.query.filter_by(status="HOLD").count()
 
     # Monthly sales
     now = datetime.now()
-    monthly_sales = Sale.query.filter(
-        db.extract("month", Sale.business_date) == now.month,
-        db.extract("year", Sale.business_date) == now.year
-    ).all()
+    start_date, end_date = get_month_range(now.month, now.year)
 
-    monthly_total = sum(s.total for s in monthly_sales)
+    monthly_total, monthly_bills = db.session.query(
+        db.func.coalesce(db.func.sum(Sale.total), 0),
+        db.func.count(Sale.id)
+    ).filter(
+        Sale.business_date >= start_date,
+        Sale.business_date < end_date
+    ).one()
 
     return jsonify({
         "today_total": today_total,
-        "today_bills": len(today_sales),
+        "today_bills": today_bills,
         "hold_count": hold_count,
         "monthly_total": monthly_total,
-        "monthly_bills": len(monthly_sales)
+        "monthly_bills": monthly_bills
     })
 
 # ==================================================
@@ -291,16 +566,14 @@ def admin_daily_data():
 
     business_date = get_business_date()
 
-    query = Sale.query.filter(
-        Sale.business_date == business_date,
-        Sale.status == "COMPLETED"
+    # The open day comes from Sale so it matches /admin/report/daily
+    bill_count, total_amount, _ = completed_sales_totals(
+        Sale.business_date == business_date
     )
 
-    sales = query.all()
-
     return jsonify({
-        "bill_count": len(sales),
-        "total_amount": sum(s.total or 0 for s in sales)
+        "bill_count": bill_count,
+        "total_amount": total_amount
     })
 # ==================================================
 # ADMIN SALES VIEW
@@ -339,70 +612,88 @@ def admin_sales_breakdown():
 # ==================================================
 # MENU
 # ==================================================
+# Plain columns: rows serialize straight to dicts, no ORM objects
+MENU_LIST_STMT = db.select(Menu.id, Menu.name, Menu.price).order_by(Menu.id)
+
+# Serialize the menu once and keep the bytes in the cache
+def refresh_menu_cache():
+    body = jsonify([
+        dict(row) for row in db.session.execute(MENU_LIST_STMT).mappings()
+    ]).get_data()
+    cache.set(MENU_CACHE_KEY, body)
+    return body
+
 @app.route("/menu")
 def get_menu():
-    return jsonify([
-        {"id": m.id, "name": m.name, "price": m.price}
-        for m in Menu.query.all()
-    ])
+    body = cache.get(MENU_CACHE_KEY)
+
+    if body is None:
+        body = refresh_menu_cache()
+
+    # ETag + short max-age: repeat loads get a 304 with no body
+    response = app.response_class(body, mimetype="application/json")
+    response.cache_control.public = True
+    response.cache_control.max_age = MENU_MAX_AGE
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route("/admin/menu/refresh", methods=["POST"])
+def admin_menu_refresh():
+    body = refresh_menu_cache()
+    return jsonify({"status": "ok", "bytes": len(body)})
 
 @app.route("/owner/dashboard")
+@cache.cached(timeout=15)
 def owner_dashboard():
     business_date = get_business_date()
 
-    sales_today = Sale.query.filter_by(
-        business_date=business_date
+    # Today's totals per payment method
+    by_method = db.session.execute(
+        db.select(
+            Sale.payment_method,
+            db.func.coalesce(db.func.sum(Sale.total), 0),
+            db.func.count(Sale.id)
+        )
+        .where(Sale.business_date == business_date)
+        .group_by(Sale.payment_method)
     ).all()
 
-    total_today = 0
-    bill_count = len(sales_today)
-
-    cash_total = 0
-    upi_total = 0
-    gpay_total = 0
-    online_total = 0
-
-    staff_data = {}
-
-    for s in sales_today:
-        total_today += s.total or 0
-
-        if s.payment_method == "CASH":
-            cash_total += s.total or 0
-        elif s.payment_method == "UPI":
-            upi_total += s.total or 0
-        elif s.payment_method == "GPAY":
-            gpay_total += s.total or 0
-        elif s.payment_method == "ONLINE":
-            online_total += s.total or 0
-
-        if s.staff_id:
-            staff = User.query.get(s.staff_id)
-            if staff:
-                staff_data.setdefault(staff.username, 0)
-                staff_data[staff.username] += s.total or 0
+    method_totals = {method: total for method, total, _ in by_method}
+    total_today = sum(total for _, total, _ in by_method)
+    bill_count = sum(count for _, _, count in by_method)
+
+    # Today's totals per staff, in order of their first bill
+    staff_rows = db.session.execute(
+        db.select(User.username, db.func.coalesce(db.func.sum(Sale.total), 0))
+        .join(User, User.id == Sale.staff_id)
+        .where(Sale.business_date == business_date)
+        .group_by(User.id, User.username)
+        .order_by(db.func.min(Sale.id))
+    ).all()
 
     hold_count = Cart.query.filter_by(status="HOLD").count()
 
     now = datetime.now()
-    monthly_sales = Sale.query.filter(
-        db.extract("month", Sale.business_date) == now.month,
-        db.extract("year", Sale.business_date) == now.year
-    ).all()
+    start_date, end_date = get_month_range(now.month, now.year)
 
-    monthly_total = sum(s.total or 0 for s in monthly_sales)
+    monthly_total = db.session.query(
+        db.func.coalesce(db.func.sum(Sale.total), 0)
+    ).filter(
+        Sale.business_date >= start_date,
+        Sale.business_date < end_date
+    ).scalar()
 
     return jsonify({
         "total_today": total_today,
         "bill_count": bill_count,
-        "cash_total": cash_total,
-        "upi_total": upi_total,
-        "gpay_total": gpay_total,
-        "online_total": online_total,
+        "cash_total": method_totals.get("CASH", 0),
+        "upi_total": method_totals.get("UPI", 0),
+        "gpay_total": method_totals.get("GPAY", 0),
+        "online_total": method_totals.get("ONLINE", 0),
         "hold_count": hold_count,
         "staff_performance": [
             {"staff": name, "total": amount}
-            for name, amount in staff_data.items()
+            for name, amount in staff_rows
         ],
         "monthly_total": monthly_total
     })
@@ -410,28 +701,86 @@ def owner_dashboard():
 # ==================================================
 # CART
 # ==================================================
+# Hot cart statements, built once at import (compiled-cache friendly)
+_line_price = db.func.coalesce(CartItem.custom_price, Menu.price, 0)
+
+CART_LINES_STMT = (
+    db.select(
+        db.func.coalesce(Menu.id, 0).label("menu_id"),
+        db.func.coalesce(
+            db.func.nullif(CartItem.custom_name, ""),
+            Menu.name,
+            "Custom Item"
+        ).label("name"),
+        CartItem.quantity,
+        _line_price.label("price"),
+        (_line_price * CartItem.quantity).label("subtotal")
+    )
+    .outerjoin(Menu, Menu.id == CartItem.menu_id)
+    .where(CartItem.cart_id == db.bindparam("cart_id"))
+    .order_by(CartItem.id)
+)
+
+# /cart/remove: decrement in place; only a last unit falls through to DELETE
+_cart_item_match = (
+    CartItem.cart_id == db.bindparam("b_cart_id"),
+    CartItem.menu_id == db.bindparam("b_menu_id")
+)
+
+CART_ITEM_DECREMENT_STMT = (
+    db.update(CartItem)
+    .where(*_cart_item_match, CartItem.quantity > 1)
+    .values(quantity=CartItem.quantity - 1)
+    .execution_options(synchronize_session=False)
+)
+
+CART_ITEM_DELETE_STMT = (
+    db.delete(CartItem)
+    .where(*_cart_item_match)
+    .execution_options(synchronize_session=False)
+)
+
+def get_cart_lines(cart_id):
+    # One JOINed query: price/name fallback and line subtotal done in SQL
+    return db.session.execute(CART_LINES_STMT, {"cart_id": cart_id}).all()
+
+def cart_payload(cart_id):
+    lines = get_cart_lines(cart_id)
+
+    return {
+        "items": [
+            {
+                "menu_id": line.menu_id,
+                "name": line.name,
+                "quantity": line.quantity,
+                "subtotal": line.subtotal
+            }
+            for line in lines
+        ],
+        "total": sum(line.subtotal for line in lines)
+    }
+
 @app.route("/cart/add", methods=["POST"])
 def add_to_cart():
-    d = request.json
+    d = request.get_json(silent=True) or {}
+
+    if not d.get("cart_id"):
+        return jsonify({"error": "Cart ID missing"}), 400
 
     # ===== NORMAL MENU ITEM =====
     if d.get("menu_id"):
 
-        item = CartItem.query.filter_by(
+        # Insert or bump quantity in one statement (uq_cart_item_cart_menu)
+        stmt = dialect_insert(CartItem).values(
             cart_id=d["cart_id"],
-            menu_id=d["menu_id"]
-        ).first()
-
-        if item:
-            item.quantity += 1
-        else:
-            db.session.add(
-                CartItem(
-                    cart_id=d["cart_id"],
-                    menu_id=d["menu_id"],
-                    quantity=1
-                )
-            )
+            menu_id=d["menu_id"],
+            quantity=1
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["cart_id", "menu_id"],
+            set_={"quantity": CartItem.quantity + stmt.excluded.quantity}
+        )
+        db.session.execute(stmt)
 
     # ===== SEASON TICKET (CUSTOM ITEM) =====
     elif d.get("custom_price"):
@@ -445,44 +794,30 @@ def add_to_cart():
             )
         )
 
+    # Send the updated cart back so the billing page skips a GET /cart/<id>
+    cart = cart_payload(d["cart_id"])
     db.session.commit()
-    return jsonify({"status": "ok"})
+    return jsonify({"status": "ok", **cart})
 
 @app.route("/cart/remove", methods=["POST"])
 def remove_from_cart():
-    d = request.json
-    item = CartItem.query.filter_by(cart_id=d["cart_id"], menu_id=d["menu_id"]).first()
-    if item:
-        if item.quantity > 1:
-            item.quantity -= 1
-        else:
-            db.session.delete(item)
-    db.session.commit()
-    return jsonify({"status": "ok"})
+    d = request.get_json(silent=True) or {}
 
-@app.route("/cart/<int:cart_id>")
-def view_cart(cart_id):
-    items = CartItem.query.filter_by(cart_id=cart_id).all()
+    if not d.get("cart_id"):
+        return jsonify({"error": "Cart ID missing"}), 400
 
-    total = 0
-    result = []
+    params = {"b_cart_id": d["cart_id"], "b_menu_id": d.get("menu_id")}
 
-    for i in items:
-        price = i.custom_price if i.custom_price is not None else (i.menu.price if i.menu else 0)
-        subtotal = price * i.quantity
-        total += subtotal
+    if not db.session.execute(CART_ITEM_DECREMENT_STMT, params).rowcount:
+        db.session.execute(CART_ITEM_DELETE_STMT, params)
 
-        result.append({
-            "menu_id": i.menu.id if i.menu else 0,
-            "name": i.custom_name if i.custom_name else (i.menu.name if i.menu else "Custom Item"),
-            "quantity": i.quantity,
-            "subtotal": subtotal
-        })
+    cart = cart_payload(d["cart_id"])
+    db.session.commit()
+    return jsonify({"status": "ok", **cart})
 
-    return jsonify({
-        "items": result,
-        "total": total
-    })
+@app.route("/cart/<int:cart_id>")
+def view_cart(cart_id):
+    return jsonify(cart_payload(cart_id))
 
 # ==================================================
 # ADMIN DELETE HOLD BILL (SAFE VERSION)
@@ -492,7 +827,7 @@ def admin_delete_hold(cart_id):
 
     try:
 
-        cart = Cart.query.get(cart_id)
+        cart = db.session.get(Cart, cart_id)
 
         if not cart:
             return jsonify({"status":"error","message":"Cart not found"})
@@ -500,11 +835,8 @@ def admin_delete_hold(cart_id):
         if cart.status != "HOLD":
             return jsonify({"status":"error","message":"Not a hold bill"})
 
-        # delete cart items
-        items = CartItem.query.filter_by(cart_id=cart_id).all()
-
-        for item in items:
-            db.session.delete(item)
+        # delete cart items (single DELETE statement)
+        CartItem.query.filter_by(cart_id=cart_id).delete(synchronize_session=False)
 
         # delete cart
         db.session.delete(cart)
@@ -521,26 +853,31 @@ def admin_delete_hold(cart_id):
 
 @app.route("/ui/bill-search")
 def bill_search_page():
-    return render_template("admin_bill_search.html")
+    return render_page("admin_bill_search.html")
 
 @app.route("/ui/admin-dashboard")
 def ui_admin_dashboard():
-    return render_template("admin_dashboard.html")
+    return render_page("admin_dashboard.html")
 
 # =========================================
 # ADMIN: CLEAR ALL HOLD BILLS
 # =========================================
-@app.route("/admin/hold/clear-all", methods=["GET"])
-def clear_all_holds():
-
-    holds = Cart.query.filter_by(status="HOLD").all()
+def delete_hold_carts():
+    # Two set-based DELETEs instead of per-cart / per-item statements
+    hold_ids = db.session.execute(
+        db.select(Cart.id).where(Cart.status == "HOLD")
+    ).scalars().all()
 
-    for cart in holds:
+    if hold_ids:
+        db.session.execute(db.delete(CartItem).where(CartItem.cart_id.in_(hold_ids)))
+        db.session.execute(db.delete(Cart).where(Cart.id.in_(hold_ids)))
 
-        CartItem.query.filter_by(cart_id=cart.id).delete()
+    return len(hold_ids)
 
-        db.session.delete(cart)
+@app.route("/admin/hold/clear-all", methods=["GET"])
+def clear_all_holds():
 
+    delete_hold_carts()
     db.session.commit()
 
     return "All hold bills cleared successfully"
@@ -571,9 +908,17 @@ def get_business_date():
 
     return now.date()
 
+# ==================================================
+# MONTH RANGE [first day, first day of next month)
+# ==================================================
+def get_month_range(month, year):
+    start_date = datetime(year, month, 1).date()
+    end_date = datetime(year + (month // 12), (month % 12) + 1, 1).date()
+    return start_date, end_date
+
 @app.route("/ui/live-dashboard")
 def live_dashboard():
-    return render_template("live_dashboard.html")
+    return render_page("live_dashboard.html")
 
 # ==================================================
 # GET CURRENT BUSINESS DATE (IST 3:30 PM CYCLE)
@@ -589,14 +934,19 @@ def get_current_business_date():
 # ==================================================
 @app.route("/cart/hold", methods=["POST"])
 def hold_cart():
-    data = request.json
-    cart = Cart.query.get(data.get("cart_id"))
+    data = request.get_json(silent=True) or {}
 
-    if cart and cart.status == "ACTIVE":
-        cart.status = "HOLD"
-        cart.customer_name = data.get("customer_name")
-        cart.customer_phone = data.get("customer_phone")
-        db.session.commit()
+    # Single UPDATE; the status check moves into the WHERE clause
+    db.session.execute(
+        db.update(Cart)
+        .where(Cart.id == data.get("cart_id"), Cart.status == "ACTIVE")
+        .values(
+            status="HOLD",
+            customer_name=data.get("customer_name"),
+            customer_phone=data.get("customer_phone")
+        )
+    )
+    db.session.commit()
 
     return jsonify({"status": "ok"})
 
@@ -607,16 +957,15 @@ def create_cart():
 
     staff_id = data.get("staff_id")
 
-    cart = Cart(
-        status="ACTIVE",
-        staff_id=staff_id
-    )
+    # INSERT ... RETURNING id; reading cart.id after commit would re-SELECT it
+    cart_id = db.session.execute(
+        db.insert(Cart).values(status="ACTIVE", staff_id=staff_id).returning(Cart.id)
+    ).scalar_one()
 
-    db.session.add(cart)
     db.session.commit()
 
     return jsonify({
-        "cart_id": cart.id
+        "cart_id": cart_id
     })
 
 @app.route("/cart/held")
@@ -630,12 +979,15 @@ def held_carts():
     if now.hour >= 15 and role != "admin":
         return jsonify([])
 
-    query = Cart.query.filter_by(status="HOLD")
+    # Read-only list: plain rows, no Cart objects
+    stmt = db.select(
+        Cart.id, Cart.customer_name, Cart.customer_phone, Cart.created_at
+    ).where(Cart.status == "HOLD")
 
     if role != "admin" and user_id:
-        query = query.filter_by(staff_id=int(user_id))
+        stmt = stmt.where(Cart.staff_id == int(user_id))
 
-    carts = query.order_by(Cart.created_at.desc()).all()
+    carts = db.session.execute(stmt.order_by(Cart.created_at.desc()))
 
     result = []
 
@@ -649,14 +1001,12 @@ def held_carts():
 
     return jsonify(result)
 
-from datetime import datetime, timedelta
-
 @app.route("/cart/resume/<int:cart_id>")
 def resume_hold(cart_id):
 
     role = request.args.get("role")
 
-    cart = Cart.query.get(cart_id)
+    cart = db.session.get(Cart, cart_id)
 
     if not cart:
         return jsonify({"error": "Cart not found"}), 404
@@ -693,34 +1043,28 @@ def resume_hold(cart_id):
 @app.route("/checkout", methods=["POST"])
 def checkout():
 
-    d = request.json or {}
+    d = request.get_json(silent=True) or {}
     cart_id = d.get("cart_id")
     discount = int(d.get("discount") or 0)
 
     if not cart_id:
         return jsonify({"error": "Cart ID missing"}), 400
 
-    items = CartItem.query.filter_by(cart_id=cart_id).all()
+    lines = get_cart_lines(cart_id)
 
-    if not items:
+    if not lines:
         return jsonify({"error": "Cart empty"}), 400
 
-    subtotal = 0
-    items_data = []
-
-    for i in items:
-        price = i.custom_price if i.custom_price is not None else (i.menu.price if i.menu else 0)
-        name = i.custom_name if i.custom_name else (i.menu.name if i.menu else "Custom Item")
-
-        item_subtotal = price * i.quantity
-        subtotal += item_subtotal
-
-        items_data.append({
-            "name": name,
-            "quantity": i.quantity,
-            "price": price,
-            "subtotal": item_subtotal
-        })
+    subtotal = sum(line.subtotal for line in lines)
+    items_data = [
+        {
+            "name": line.name,
+            "quantity": line.quantity,
+            "price": line.price,
+            "subtotal": line.subtotal
+        }
+        for line in lines
+    ]
 
     final_total = max(subtotal - discount, 0)
 
@@ -742,18 +1086,29 @@ def checkout():
 
     db.session.add(sale)
 
-    cart = Cart.query.get(cart_id)
-    if cart:
-        cart.status = "PAID"
+    # Flush now so the id comes back from the INSERT; commit expires sale
+    db.session.flush()
+    sale_id = sale.id
+    sale_staff_id, business_date = sale.staff_id, sale.business_date
+
+    record_daily_sale(business_date, final_total, discount)
+
+    # Flip the cart straight to PAID (no SELECT) in the same transaction
+    db.session.execute(
+        db.update(Cart).where(Cart.id == cart_id).values(status="PAID")
+    )
 
     db.session.commit()
 
+    if sale_staff_id:
+        cache.delete(staff_report_key(sale_staff_id, business_date))
+
     return jsonify({
         "subtotal": subtotal,
         "discount": discount,
         "total": final_total,
         "bill_no": bill_no,
-        "sale_id": sale.id
+        "sale_id": sale_id
     })
 
 # ==================================================
@@ -761,35 +1116,53 @@ def checkout():
 # ==================================================
 @app.route("/admin/staff/list")
 def admin_staff_list():
-    staff = User.query.filter(User.role != "admin").all()
-    return jsonify([
-        {"id": s.id, "username": s.username, "status": s.status}
-        for s in staff
-    ])
+    staff = db.session.execute(
+        db.select(User.id, User.username, User.status).where(User.role != "admin")
+    ).mappings()
+    return jsonify([dict(s) for s in staff])
 
 @app.route("/admin/staff/toggle", methods=["POST"])
 def admin_staff_toggle():
-    staff = User.query.get(request.json.get("staff_id"))
-    if not staff or staff.role == "admin":
+    data = request.get_json(silent=True) or {}
+
+    toggled = db.session.execute(
+        db.update(User)
+        .where(User.id == data.get("staff_id"), User.role != "admin")
+        .values(status=db.case((User.status == "ACTIVE", "DISABLED"), else_="ACTIVE"))
+    ).rowcount
+
+    if not toggled:
         return jsonify({"status": "error"}), 400
 
-    staff.status = "DISABLED" if staff.status == "ACTIVE" else "ACTIVE"
     db.session.commit()
     return jsonify({"status": "ok"})
 
 @app.route("/admin/staff/reset-password", methods=["POST"])
 def admin_staff_reset_password():
-    staff = User.query.get(request.json.get("staff_id"))
+    data = request.get_json(silent=True) or {}
+
+    if not data.get("staff_id") or not data.get("new_password"):
+        return jsonify({"status": "error", "message": "Missing fields"}), 400
+
+    staff = db.session.get(User, data.get("staff_id"))
     if not staff or staff.role == "admin":
         return jsonify({"status": "error"}), 400
 
-    staff.password = generate_password_hash(request.json.get("new_password"))
+    staff.password = hash_password(data.get("new_password"))
     db.session.commit()
     return jsonify({"status": "ok"})
 
 # ==================================================
 # STAFF DAILY SALES (ONLY THEIR OWN)
 # ==================================================
+# Cached for 60 s in Redis only; checkout and void delete the staff/day
+# entry. SimpleCache is per worker, so that delete wouldn't reach the
+# other workers' copies and the report is computed on every request.
+STAFF_REPORT_CACHE_SECONDS = 60 if REDIS_URL else None
+
+def staff_report_key(staff_id, business_date):
+    return f"rpt:s:{staff_id}:{business_date.isoformat()}"
+
 @app.route("/staff/report/daily")
 def staff_daily_report():
     staff_id = request.args.get("staff_id")
@@ -800,16 +1173,25 @@ def staff_daily_report():
             "total_amount": 0
         })
 
-    sales = Sale.query.filter_by(
-    staff_id=staff_id,
-    business_date=get_business_date(),
-    status="COMPLETED"
-).all()
+    business_date = get_business_date()
+    key = staff_report_key(staff_id, business_date)
+    report = cache.get(key) if STAFF_REPORT_CACHE_SECONDS else None
+
+    if report is None:
+        bill_count, total_amount = db.session.query(
+            db.func.count(Sale.id),
+            db.func.coalesce(db.func.sum(Sale.total), 0)
+        ).filter(
+            Sale.staff_id == staff_id,
+            Sale.business_date == business_date,
+            Sale.status == "COMPLETED"
+        ).one()
 
-    return jsonify({
-        "bill_count": len(sales),
-        "total_amount": sum(s.total for s in sales)
-    })
+        report = {"bill_count": bill_count, "total_amount": total_amount}
+        if STAFF_REPORT_CACHE_SECONDS:
+            cache.set(key, report, timeout=STAFF_REPORT_CACHE_SECONDS)
+
+    return jsonify(report)
 
 # ==================================================
 # ADMIN DAILY REPORT (WITH STAFF FILTER)
@@ -824,20 +1206,24 @@ def admin_daily_report():
         if date_str else get_business_date()
     )
 
-    query = Sale.query.filter(
-    Sale.business_date == business_date,
-    Sale.status == "COMPLETED"
-)
+    query = db.session.query(
+        db.func.count(Sale.id),
+        db.func.coalesce(db.func.sum(Sale.total), 0),
+        db.func.coalesce(db.func.sum(Sale.discount), 0)
+    ).filter(
+        Sale.business_date == business_date,
+        Sale.status == "COMPLETED"
+    )
 
     if staff_id:
         query = query.filter(Sale.staff_id == int(staff_id))
 
-    sales = query.order_by(Sale.id.asc()).all()
+    bill_count, total_amount, total_discount = query.one()
 
     return jsonify({
-    "bill_count": len(sales),
-    "total_amount": sum((s.total or 0) for s in sales),
-    "total_discount": sum((s.discount or 0) for s in sales)
+    "bill_count": bill_count,
+    "total_amount": total_amount,
+    "total_discount": total_discount
 })
 
 # ==================================================
@@ -858,8 +1244,6 @@ def admin_daily_excel():
     Sale.status == "COMPLETED"
 ).order_by(Sale.id.asc()).all()
 
-    import pandas as pd
-
     rows = []
 
     for s in sales:
@@ -894,17 +1278,18 @@ def staff_discount_report():
     if not staff_id:
         return jsonify({"total_discount": 0})
 
-    sales = Sale.query.filter_by(
-        staff_id=staff_id,
-        business_date=get_business_date(),
-        status="COMPLETED"
-    ).all()
-
-    total_discount = sum(s.discount or 0 for s in sales)
+    total_discount, bill_count = db.session.query(
+        db.func.coalesce(db.func.sum(Sale.discount), 0),
+        db.func.count(Sale.id)
+    ).filter(
+        Sale.staff_id == staff_id,
+        Sale.business_date == get_business_date(),
+        Sale.status == "COMPLETED"
+    ).one()
 
     return jsonify({
         "total_discount": total_discount,
-        "bill_count": len(sales)
+        "bill_count": bill_count
     })
 
     bill_no = request.args.get("bill_no")
@@ -934,26 +1319,35 @@ def staff_discount_report():
 @app.route("/admin/backup")
 def backup_db():
 
-    backup_file = "backup.xlsx"
-
-    sales = Sale.query.all()
-
-    rows = []
+    # Stream plain column tuples in batches instead of loading every Sale object
+    rows = db.session.execute(
+        db.select(
+            Sale.bill_no,
+            Sale.customer_name,
+            Sale.customer_phone,
+            Sale.payment_method,
+            Sale.total,
+            Sale.business_date
+        )
+        .order_by(Sale.id.asc())
+        .execution_options(yield_per=1000)
+    )
 
-    for s in sales:
-        rows.append({
-            "Bill": s.bill_no,
-            "Customer": s.customer_name,
-            "Phone": s.customer_phone,
-            "Payment": s.payment_method,
-            "Total": s.total,
-            "Date": s.business_date
-        })
+    df = pd.DataFrame.from_records(
+        rows,
+        columns=["Bill", "Customer", "Phone", "Payment", "Total", "Date"]
+    )
 
-    df = pd.DataFrame(rows)
-    df.to_excel(backup_file, index=False)
+    output = io.BytesIO()
+    df.to_excel(output, index=False)
+    output.seek(0)
 
-    return send_file(backup_file, as_attachment=True)
+    return send_file(
+        output,
+        as_attachment=True,
+        download_name="backup.xlsx",
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    )
 
 # ==================================================
 # ADMIN DAILY PDF (WITH BILL NO)
@@ -998,7 +1392,7 @@ def admin_daily_pdf():
     total_amount = 0
 
     for s in sales:
-        staff = User.query.get(s.staff_id)
+        staff = db.session.get(User, s.staff_id)
 
         pdf.drawString(50, y, s.bill_no)
         pdf.drawString(130, y, staff.username if staff else "")
@@ -1049,7 +1443,7 @@ def admin_discount_report():
             total_discount += discount_value
 
             if s.staff_id:
-                staff = User.query.get(s.staff_id)
+                staff = db.session.get(User, s.staff_id)
                 if staff:
                     staff_summary.setdefault(staff.username, 0)
                     staff_summary[staff.username] += discount_value
@@ -1074,16 +1468,34 @@ def admin_monthly_report():
     month = int(request.args.get("month"))
     year = int(request.args.get("year"))
 
-    sales = Sale.query.filter(
-    db.extract("month", Sale.business_date) == month,
-    db.extract("year", Sale.business_date) == year,
-    Sale.status == "COMPLETED"
-).order_by(Sale.id.asc()).all()
+    start_date, end_date = get_month_range(month, year)
+
+    open_date = get_business_date()
+
+    # Closed days: at most ~31 summary rows instead of every sale
+    closed_bills, closed_total, closed_discount = db.session.query(
+        db.func.coalesce(db.func.sum(DailySales.bill_count), 0),
+        db.func.coalesce(db.func.sum(DailySales.total), 0),
+        db.func.coalesce(db.func.sum(DailySales.discount), 0)
+    ).filter(
+        DailySales.business_date >= start_date,
+        DailySales.business_date < min(end_date, open_date)
+    ).one()
+
+    # The open day (if in this month) comes from Sale
+    open_bills, open_total, open_discount = completed_sales_totals(
+        Sale.business_date >= max(start_date, open_date),
+        Sale.business_date < end_date
+    )
+
+    bill_count = closed_bills + open_bills
+    total_amount = closed_total + open_total
+    total_discount = closed_discount + open_discount
 
     return jsonify({
-    "bill_count": len(sales),
-    "total_amount": sum((s.total or 0) for s in sales),
-    "total_discount": sum(s.discount for s in sales)  # NEW
+    "bill_count": bill_count,
+    "total_amount": total_amount,
+    "total_discount": total_discount  # NEW
 })
 
 # ==================================================
@@ -1092,7 +1504,7 @@ def admin_monthly_report():
 @app.route("/bill/<int:sale_id>/pdf")
 def generate_bill_pdf(sale_id):
 
-    sale = Sale.query.get_or_404(sale_id)
+    sale = db.get_or_404(Sale, sale_id)
 
     buffer = io.BytesIO()
     pdf = canvas.Canvas(buffer, pagesize=A4)
@@ -1179,12 +1591,11 @@ def admin_monthly_excel():
     month = int(month)
     year = int(year)
 
-    start_date = datetime(year, month, 1)
-    end_date = datetime(year + (month // 12), (month % 12) + 1, 1)
+    start_date, end_date = get_month_range(month, year)
 
     query = Sale.query.filter(
-    Sale.business_date >= start_date.date(),
-    Sale.business_date < end_date.date(),
+    Sale.business_date >= start_date,
+    Sale.business_date < end_date,
     Sale.status == "COMPLETED"
 )
 
@@ -1196,7 +1607,7 @@ def admin_monthly_excel():
     data = []
 
     for s in sales:
-        staff = User.query.get(s.staff_id)
+        staff = db.session.get(User, s.staff_id)
         data.append({
     "Bill Number": s.bill_no,
     "Staff ID": s.staff_id,
@@ -1237,12 +1648,11 @@ def admin_monthly_pdf():
     month = int(month)
     year = int(year)
 
-    start_date = datetime(year, month, 1)
-    end_date = datetime(year + (month // 12), (month % 12) + 1, 1)
+    start_date, end_date = get_month_range(month, year)
 
     query = Sale.query.filter(
-    Sale.business_date >= start_date.date(),
-    Sale.business_date < end_date.date(),
+    Sale.business_date >= start_date,
+    Sale.business_date < end_date,
     Sale.status == "COMPLETED"
 )
 
@@ -1263,7 +1673,7 @@ def admin_monthly_pdf():
     total = 0
 
     for s in sales:
-        staff = User.query.get(s.staff_id)
+        staff = db.session.get(User, s.staff_id)
         pdf.drawString(50, y, s.bill_no)
         pdf.drawString(150, y, staff.username if staff else "")
         pdf.drawString(250, y, s.payment_method or "")
@@ -1299,21 +1709,7 @@ def admin_clear_all_holds():
 
     try:
 
-        holds = Cart.query.filter_by(status="HOLD").all()
-
-        deleted = 0
-
-        for cart in holds:
-
-            # delete items first
-            items = CartItem.query.filter_by(cart_id=cart.id).all()
-
-            for item in items:
-                db.session.delete(item)
-
-            db.session.delete(cart)
-
-            deleted += 1
+        deleted = delete_hold_carts()
 
         db.session.commit()
 
@@ -1342,21 +1738,26 @@ def business_date_check():
 # ==================================================
 @app.route("/admin/staff/update-username", methods=["POST"])
 def admin_update_staff_username():
-    data = request.json
-    staff = User.query.get(data.get("staff_id"))
+    data = request.get_json(silent=True) or {}
+    new_username = (data.get("new_username") or "").strip()
+
+    if not data.get("staff_id") or not new_username:
+        return jsonify({"status": "error", "message": "Missing fields"}), 400
+
+    staff = db.session.get(User, data.get("staff_id"))
 
     if not staff or staff.role == "admin":
         return jsonify({"status": "error"}), 400
 
-    new_username = data.get("new_username").strip()
+    # Prevent duplicate usernames (the unique constraint decides, no race)
+    staff.username = new_username
 
-    # Prevent duplicate usernames
-    if User.query.filter_by(username=new_username).first():
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
         return jsonify({"status": "exists"}), 400
 
-    staff.username = new_username
-    db.session.commit()
-
     return jsonify({"status": "ok"})
 
 # ==================================================
@@ -1400,7 +1801,7 @@ def staff_daily_pdf():
     pdf.drawString(50, y, f"Business Date: {business_date} ({day_name})")
     y -= 20
 
-    staff = User.query.get(staff_id)
+    staff = db.session.get(User, staff_id)
     pdf.drawString(50, y, f"Staff: {staff.username if staff else ''}")
     y -= 30
 
@@ -1500,49 +1901,158 @@ def handle_exception(e):
     traceback.print_exc()
     print("=============================================\n")
 
+    # Keep 4xx codes from werkzeug (e.g. 413 body too large)
+    status_code = e.code if isinstance(e, HTTPException) else 500
+
     return jsonify({
         "status": "error",
         "type": error_type,
         "message": error_message
-    }), 500
+    }), status_code
 # ==================================================
 # INIT DB
 # ==================================================
+DEFAULT_USERS = [("admin", "admin123", "admin")] + [
+    (f"staff{i}", "1234", "staff") for i in range(1, 11)
+]
+
+DEFAULT_MENU = [
+    {"name": "Full Set", "price": 580},
+    {"name": "Half Set", "price": 300},
+    {"name": "Three Tickets", "price": 150},
+    {"name": "Custom Amount", "price": 0}  # NEW
+]
+
+_db_initialized = False
+
+# Any fixed key; shared by every process that runs init_db
+INIT_DB_LOCK_ID = 982374
+
+@contextmanager
+def init_db_lock():
+    # Postgres: one init at a time when several instances boot together.
+    # Session-level lock, because create_all() uses its own connections.
+    if db.engine.dialect.name != "postgresql":
+        yield
+        return
+
+    with db.engine.connect() as conn:
+        conn.execute(db.text("SELECT pg_advisory_lock(:id)"), {"id": INIT_DB_LOCK_ID})
+        try:
+            yield
+        finally:
+            conn.execute(db.text("SELECT pg_advisory_unlock(:id)"), {"id": INIT_DB_LOCK_ID})
+
+def merge_duplicate_cart_items():
+    # Older databases can hold several rows per (cart_id, menu_id): fold
+    # them into the lowest id so the unique index can be created
+    keep_ids = (
+        db.select(db.func.min(CartItem.id))
+        .where(CartItem.menu_id.isnot(None))
+        .group_by(CartItem.cart_id, CartItem.menu_id)
+    )
+    duplicated_ids = keep_ids.having(db.func.count(CartItem.id) > 1)
+
+    others = db.aliased(CartItem)
+    line_quantity = (
+        db.select(db.func.sum(others.quantity))
+        .where(others.cart_id == CartItem.cart_id, others.menu_id == CartItem.menu_id)
+        .scalar_subquery()
+    )
+
+    db.session.execute(
+        db.update(CartItem)
+        .where(CartItem.id.in_(duplicated_ids))
+        .values(quantity=line_quantity)
+        .execution_options(synchronize_session=False)
+    )
+    merged = db.session.execute(
+        db.delete(CartItem)
+        .where(CartItem.menu_id.isnot(None), CartItem.id.notin_(keep_ids))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+
+    if merged:
+        print("Merged duplicate cart items:", merged)
+
 def init_db():
-    with app.app_context():
+    global _db_initialized
+
+    if _db_initialized:
+        return
+
+    with app.app_context(), init_db_lock():
         db.create_all()
 
-        # Create admin if not exists
-        if not User.query.filter_by(username="admin").first():
-            db.session.add(User(
-                username="admin",
-                password=generate_password_hash("admin123"),
-                role="admin"
-            ))
-
-        # Create staff1 to staff10
-        for i in range(1, 11):
-            username = f"staff{i}"
-            if not User.query.filter_by(username=username).first():
-                db.session.add(User(
-                    username=username,
-                    password=generate_password_hash("1234"),
-                    role="staff"
-                ))
+        cart_item_indexes = {
+            index["name"] for index in db.inspect(db.engine).get_indexes("cart_item")
+        }
+        if "uq_cart_item_cart_menu" not in cart_item_indexes:
+            merge_duplicate_cart_items()
+
+        # create_all() skips existing tables, so add any new indexes.
+        # Don't start without them: /cart/add's upsert needs the unique one.
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    index.create(db.engine, checkfirst=True)
+                except Exception as e:
+                    print("INDEX CREATE FAILED:", index.name, e)
+                    raise
+
+        # Create admin + staff1 to staff10 that don't exist yet
+        # (one lookup, one multi-row INSERT)
+        existing = set(db.session.execute(
+            db.select(User.username).where(
+                User.username.in_([username for username, _, _ in DEFAULT_USERS])
+            )
+        ).scalars())
+
+        new_users = [
+            {"username": username, "password": hash_password(password), "role": role}
+            for username, password, role in DEFAULT_USERS
+            if username not in existing
+        ]
+
+        # ON CONFLICT: another process seeding at the same time is harmless
+        if new_users:
+            db.session.execute(
+                dialect_insert(User).on_conflict_do_nothing(index_elements=["username"]),
+                new_users
+            )
+
+        # Backfill the summary table the first time it exists
+        if not DailySales.query.first():
+            rebuild_daily_sales()
 
         # Default menu
         if not Menu.query.first():
-            db.session.add_all([
-                Menu(name="Full Set", price=580),
-                Menu(name="Half Set", price=300),
-                Menu(name="Three Tickets", price=150),
-                Menu(name="Custom Amount", price=0)  # NEW
-
-            ])
+            db.session.execute(db.insert(Menu), DEFAULT_MENU)
 
         db.session.commit()
 
-init_db()
+        # Warm the menu bytes (gunicorn workers fork from this process)
+        refresh_menu_cache()
+
+    _db_initialized = True
+
+# Run once per deploy (`flask --app app init-db`); gunicorn.conf.py calls
+# init_db() in the master so workers boot without touching the DB
+@app.cli.command("init-db")
+def init_db_command():
+    init_db()
+    print("Database initialized")
+
+# Recompute the summary from Sale, e.g. after a rolling deploy where an
+# old instance recorded sales without updating it
+@app.cli.command("rebuild-daily-sales")
+def rebuild_daily_sales_command():
+    with init_db_lock():
+        rebuild_daily_sales()
+        db.session.commit()
+    print("Daily sales summary rebuilt")
 
 if __name__ == "__main__":
+    init_db()
     app.run(host="0.0.0.0", port=5000)
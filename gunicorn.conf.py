@@ -0,0 +1,50 @@
+# ==================================================
+# GUNICORN CONFIG (auto-loaded by `gunicorn app:app`)
+# ==================================================
+import os
+
+# GUNICORN_GEVENT=1 (pip install -r requirements-gevent.txt): one worker
+# serves many requests while they wait on Postgres. Patch before anything
+# else is imported, so the app, SQLAlchemy's pool and its locks are built
+# on gevent primitives in the master that workers fork from.
+USE_GEVENT = os.environ.get("GUNICORN_GEVENT") == "1"
+
+if USE_GEVENT:
+    from gevent import monkey
+    monkey.patch_all()
+
+# Threaded workers: a request waiting on Postgres no longer blocks the
+# whole worker. Keep threads <= DB_POOL_SIZE + DB_MAX_OVERFLOW (app.py).
+#
+# Every worker holds its own DB pool and copy of pandas, so the default is
+# a small 2 workers x 4 threads. To scale, raise WEB_CONCURRENCY while
+#   workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+# stays under the Postgres connection limit (leave room for other
+# clients) and workers fit in the instance's memory.
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+# Under gevent, requests beyond the DB pool queue for a connection
+# (pool_timeout)
+if USE_GEVENT:
+    worker_class = "gevent"
+    worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 100))
+
+timeout = 120
+
+# Create tables / seed data once in the master, not in every worker
+def on_starting(server):
+    from app import app, db, init_db
+
+    init_db()
+
+    # Don't hand the master's pooled connections to forked workers
+    with app.app_context():
+        db.engine.dispose()
+
+# Make psycopg2 yield to other greenlets instead of blocking the worker
+def post_fork(server, worker):
+    if USE_GEVENT:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()